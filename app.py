@@ -1,19 +1,24 @@
+import hashlib
+import io
 import os
 import re
-import unicodedata
+import threading
+from collections import defaultdict, deque
 from datetime import datetime
-from difflib import SequenceMatcher, get_close_matches
 
 from flask import Flask, render_template, request, redirect, url_for, send_file, flash
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pcsv
+from rapidfuzz import fuzz, process
 from werkzeug.utils import secure_filename
 
 # --- Configuration ---
-UPLOAD_DIR = "uploads"
 OUTPUT_DIR = "outputs"
 ALLOWED_EXT = {"csv"}
+ROSTER_CACHE_SIZE = 16  # parsed master lists kept in memory, per worker
 
-os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 app = Flask(__name__)
@@ -30,22 +35,22 @@ def sanitize_filename_part(s: str) -> str:
     s = re.sub(r"[\s-]+", "_", s.strip())
     return s or "value"
 
-def normalize_name(s: str) -> str:
-    if s is None:
-        return ""
-    s = str(s).strip()
-    if s == "":
-        return ""
+_PUNCT_RE = re.compile(r"[^\w\s]")
+_SPACE_RE = re.compile(r"\s+")
+_SAL_RE = re.compile(r"^(mr|ms|mrs|miss|dr|prof|sir)\s+")
+
+def normalize_series(s: pd.Series) -> pd.Series:
+    # normalize a whole column of names in one pass; missing values become ""
+    s = s.fillna("").astype(str).str.strip()
     # remove accents
-    s = unicodedata.normalize("NFKD", s)
-    s = s.encode("ascii", "ignore").decode("ascii")
-    s = s.lower()
+    s = s.str.normalize("NFKD").str.encode("ascii", "ignore").str.decode("ascii")
+    s = s.str.lower()
     # remove punctuation except spaces
-    s = re.sub(r"[^\w\s]", " ", s)
+    s = s.str.replace(_PUNCT_RE, " ", regex=True)
     # collapse whitespace
-    s = " ".join(s.split())
+    s = s.str.replace(_SPACE_RE, " ", regex=True).str.strip()
     # remove salutations that commonly appear
-    s = re.sub(r"^(mr|ms|mrs|miss|dr|prof|sir)\s+", "", s)
+    s = s.str.replace(_SAL_RE, "", regex=True)
     return s
 
 def choose_name_column(df: pd.DataFrame) -> str:
@@ -58,115 +63,180 @@ def choose_name_column(df: pd.DataFrame) -> str:
     # fallback to first column name
     return df.columns[0]
 
+def choose_batch_column(df: pd.DataFrame):
+    candidates = {c.lower(): c for c in df.columns}
+    for want in ("batch", "batch_name", "batchname"):
+        if want in candidates:
+            return candidates[want]
+    # no batch information
+    return None
+
+# parsed + normalized master lists keyed by a digest of the uploaded bytes, so re-uploading
+# the same roster skips CSV parsing and name normalization (most recently used last)
+_roster_cache = {}
+# guards the cache bookkeeping under threaded servers; parsing runs outside the lock
+_roster_cache_lock = threading.Lock()
+
+def read_roster(data: bytes):
+    key = hashlib.blake2b(data, digest_size=16).digest()
+    with _roster_cache_lock:
+        entry = _roster_cache.pop(key, None)
+    if entry is None:
+        df = pd.read_csv(io.BytesIO(data), dtype=str)
+        name_col = choose_name_column(df)
+        entry = (df, name_col, normalize_series(df[name_col]))
+    with _roster_cache_lock:
+        _roster_cache[key] = entry
+        while len(_roster_cache) > ROSTER_CACHE_SIZE:
+            _roster_cache.pop(next(iter(_roster_cache)), None)
+    return entry
+
 def pairwise_match(total_df: pd.DataFrame, present_df: pd.DataFrame,
                    name_col_total: str, name_col_present: str,
-                   fuzzy_cutoff: float = 0.72, token_jaccard_cutoff: float = 0.5):
-    # prepare
-    total = total_df.copy().reset_index(drop=True)
-    present = present_df.copy().reset_index(drop=True)
-
-    total["__norm"] = total[name_col_total].astype(str).apply(normalize_name)
-    present["__norm"] = present[name_col_present].astype(str).apply(normalize_name)
-
-    # maps from normalized name to list of total indices (for fast exact lookups)
-    norm_to_indices = {}
-    for idx, nm in total["__norm"].items():
-        norm_to_indices.setdefault(nm, []).append(idx)
-
-    unmatched_total_indices = set(total.index.tolist())
+                   fuzzy_cutoff: float = 0.72, token_jaccard_cutoff: float = 0.5,
+                   close_cutoff: float = 0.6,
+                   batch_col_total: str = None, batch_col_present: str = None,
+                   total_norm: pd.Series = None):
+    # prepare: matching is positional and normalized names are kept apart from the frames,
+    # so neither input is copied (the roster frame may be shared via the roster cache)
+    total = total_df
+    if not total.index.equals(pd.RangeIndex(len(total))):
+        total = total.reset_index(drop=True)
+    present = present_df
+
+    # total_norm: normalized total names computed earlier (e.g. cached with the roster)
+    if total_norm is None:
+        total_norm = normalize_series(total[name_col_total])
+    present_norm = normalize_series(present[name_col_present])
+
+    # exact-match keys: normalized name, or (name, batch) pairs when both lists carry a batch
+    if batch_col_total and batch_col_present:
+        total_keys = pd.MultiIndex.from_arrays([total_norm, normalize_series(total[batch_col_total])])
+        present_keys = pd.MultiIndex.from_arrays([present_norm, normalize_series(present[batch_col_present])])
+    else:
+        total_keys = pd.Index(total_norm)
+        present_keys = pd.Index(present_norm)
+
+    # codes for the keys: position in the roster's unique keys, built once and probed for
+    # both lists (-1 = present key not on the roster), so exact lookups hash small ints
+    roster_keys = total_keys.unique()
+    total_codes = roster_keys.get_indexer(total_keys)
+    present_codes = roster_keys.get_indexer(present_keys).tolist()
+
+    # maps from name code to queue of total indices (for fast exact lookups)
+    norm_to_indices = {int(code): deque(idx.tolist())
+                       for code, idx in pd.Series(total_codes).groupby(total_codes).indices.items()}
+
+    unmatched = np.ones(len(total), dtype=bool)  # total rows not yet allocated
     matched_pairs = []   # tuples: (present_row_index, total_index, method)
     not_found_present = []  # list of present original strings that couldn't be matched
 
-    total_norm_list = total["__norm"].tolist()
-    total_token_sets = [set(n.split()) for n in total_norm_list]
-
-    # helper to allocate a total index when multiple available
+    total_norm_list = total_norm.tolist()
+    total_norm_arr = np.array(total_norm_list, dtype=object)
+    total_norm_lens = np.fromiter(map(len, total_norm_list), dtype=np.int32, count=len(total_norm_list))
+    fuzzy_floor = min(fuzzy_cutoff, close_cutoff) * 100  # lowest fuzzy score that can match
+    present_norm_list = present_norm.tolist()
+    present_orig = present[name_col_present].to_numpy()
+    total_token_sets = [frozenset(n.split()) for n in total_norm_list]
+    total_token_lens = np.fromiter((len(t) for t in total_token_sets), dtype=np.int32,
+                                   count=len(total_token_sets))
+
+    # inverted index: token -> sorted array of total indices whose normalized name contains it
+    token_to_indices = defaultdict(list)
+    for t_idx, t_tokens in enumerate(total_token_sets):
+        for tok in t_tokens:
+            token_to_indices[tok].append(t_idx)
+    token_to_indices = {tok: np.array(idx, dtype=np.intp) for tok, idx in token_to_indices.items()}
+
+    # helper to mark a total index as taken
+    def take(t_idx):
+        unmatched[t_idx] = False
+
+    # helper to allocate a total index when multiple available; indices already
+    # taken (here or by a later step) are popped so they are never scanned again
     def allocate_from_list(lst):
-        for x in lst:
-            if x in unmatched_total_indices:
-                unmatched_total_indices.remove(x)
+        while lst:
+            x = lst.popleft()
+            if unmatched[x]:
+                take(x)
                 return x
         return None
 
-    for p_idx, p_row in present.iterrows():
-        p_orig = present.at[p_idx, name_col_present]
-        p_norm = present.at[p_idx, "__norm"]
+    for p_idx, p_norm in enumerate(present_norm_list):
+        p_orig = present_orig[p_idx]
         if not p_norm:
             not_found_present.append(p_orig)
             continue
 
-        # 1) exact normalized match
-        if p_norm in norm_to_indices:
-            chosen = allocate_from_list(norm_to_indices[p_norm])
+        # 1) exact normalized match (within the same batch, when known)
+        p_code = present_codes[p_idx]
+        if p_code >= 0:
+            chosen = allocate_from_list(norm_to_indices[p_code])
             if chosen is not None:
                 matched_pairs.append((p_idx, chosen, "exact"))
                 continue
 
-        # 2) token-subset (e.g., "Avesh" in "Avesh Sajiwala")
+        # 2) token-subset (e.g., "Avesh" in "Avesh Sajiwala");
+        # only unmatched total names sharing at least one token can score. Candidates come
+        # from the posting lists, where each one appears once per shared token, so its count
+        # is the size of the token intersection
         p_tokens = set(p_norm.split())
+        postings = [token_to_indices[tok] for tok in p_tokens if tok in token_to_indices]
         best_idx = None
         best_score = 0.0
-        for t_idx in list(unmatched_total_indices):
-            t_tokens = total_token_sets[t_idx]
-            if not t_tokens or not p_tokens:
-                continue
-            inter = p_tokens.intersection(t_tokens)
-            # token coverage score: intersection/len(p_tokens)
-            coverage = (len(inter) / max(1, len(p_tokens)))
-            # also consider intersection relative to union
-            jaccard = len(inter) / len(p_tokens.union(t_tokens))
-            # prefer high coverage or high jaccard
-            score = max(coverage, jaccard)
-            if score > best_score:
-                best_score = score
-                best_idx = t_idx
+        if postings:
+            cands, inter = np.unique(np.concatenate(postings), return_counts=True)
+            keep = unmatched[cands]
+            cands, inter = cands[keep], inter[keep]
+            if len(cands):
+                # token coverage score: intersection/len(p_tokens)
+                coverage = inter / len(p_tokens)
+                # also consider intersection relative to union
+                jaccard = inter / (len(p_tokens) + total_token_lens[cands] - inter)
+                # prefer high coverage or high jaccard (first, i.e. lowest index, on ties)
+                scores = np.maximum(coverage, jaccard)
+                best = int(scores.argmax())
+                best_idx, best_score = int(cands[best]), float(scores[best])
 
         if best_idx is not None and best_score >= token_jaccard_cutoff:
             # allocate
-            if best_idx in unmatched_total_indices:
-                unmatched_total_indices.remove(best_idx)
+            if unmatched[best_idx]:
+                take(best_idx)
                 matched_pairs.append((p_idx, best_idx, f"token-match:{best_score:.2f}"))
                 continue
 
-        # 3) fuzzy matching using SequenceMatcher over normalized strings
+        # 3) fuzzy matching over the unmatched total names. Prefilter: the InDel distance is
+        # at least the length difference, so ratio <= 2 * min(len) / (sum of lens); names whose
+        # bound is below the floor can never match and are dropped for all rows at once.
+        # extractOne then raises its cutoff to the best score found so far, so worse
+        # candidates are abandoned early
         best_idx = None
         best_ratio = 0.0
-        for t_idx in list(unmatched_total_indices):
-            t_norm = total_norm_list[t_idx]
-            if not t_norm:
-                continue
-            ratio = SequenceMatcher(None, p_norm, t_norm).ratio()
-            if ratio > best_ratio:
-                best_ratio = ratio
-                best_idx = t_idx
+        p_len = len(p_norm)
+        reachable = 200 * np.minimum(total_norm_lens, p_len) >= fuzzy_floor * (total_norm_lens + p_len)
+        cand_idx = np.flatnonzero(unmatched & reachable)
+        best = process.extractOne(p_norm, total_norm_arr[cand_idx], scorer=fuzz.ratio,
+                                  score_cutoff=fuzzy_floor)
+        if best is not None:
+            best_idx = int(cand_idx[best[2]])
+            best_ratio = best[1] / 100
 
         if best_ratio >= fuzzy_cutoff and best_idx is not None:
-            unmatched_total_indices.remove(best_idx)
+            take(best_idx)
             matched_pairs.append((p_idx, best_idx, f"fuzzy:{best_ratio:.2f}"))
             continue
 
-        # 4) last-chance: try get_close_matches over total_norm_list
-        close = get_close_matches(p_norm, [total_norm_list[i] for i in unmatched_total_indices], n=1, cutoff=0.6)
-        if close:
-            # find index in total_norm_list that equals close[0]
-            candidate = None
-            for t_idx in list(unmatched_total_indices):
-                if total_norm_list[t_idx] == close[0]:
-                    candidate = t_idx
-                    break
-            if candidate is not None:
-                unmatched_total_indices.remove(candidate)
-                matched_pairs.append((p_idx, candidate, "close-match"))
-                continue
+        # 4) last-chance: accept the same best candidate at the looser close-match cutoff
+        if best_ratio >= close_cutoff and best_idx is not None:
+            take(best_idx)
+            matched_pairs.append((p_idx, best_idx, "close-match"))
+            continue
 
         # no match found
         not_found_present.append(p_orig)
 
-    # remaining unmatched_total_indices are absentees
-    absentees_idx_sorted = sorted(list(unmatched_total_indices))
-    absentees_df = total.loc[absentees_idx_sorted].copy()
-    # drop helper column
-    absentees_df = absentees_df.drop(columns=["__norm"], errors="ignore")
+    # every total row not allocated to a present row is an absentee
+    absentees_df = total[unmatched]
 
     return {
         "total_count": len(total),
@@ -220,34 +290,33 @@ def upload():
             flash("Only CSV files are supported.")
             return redirect(request.url)
 
-        # save uploads temporarily
-        tpath = os.path.join(UPLOAD_DIR, secure_filename("total.csv"))
-        ppath = os.path.join(UPLOAD_DIR, secure_filename("present.csv"))
-        total_file.save(tpath)
-        present_file.save(ppath)
-
-        # read safe with pandas (dtype=str to preserve everything)
+        # read straight from the upload streams (no temporary copy on disk) with pandas
+        # (dtype=str to preserve everything); the master list is reused from the roster
+        # cache when the same file comes again
         try:
-            total_df = pd.read_csv(tpath, dtype=str)
-            present_df = pd.read_csv(ppath, dtype=str)
+            total_df, total_name_col, total_norm = read_roster(total_file.read())
+            present_df = pd.read_csv(present_file.stream, dtype=str)
         except Exception as e:
             flash(f"Failed to read CSV: {e}")
             return redirect(request.url)
 
         # detect name columns
-        total_name_col = choose_name_column(total_df)
         present_name_col = choose_name_column(present_df)
+        total_batch_col = choose_batch_column(total_df)
+        present_batch_col = choose_batch_column(present_df)
 
         # run matching
         result = pairwise_match(total_df, present_df, total_name_col, present_name_col,
-                                fuzzy_cutoff=0.72, token_jaccard_cutoff=0.5)
+                                fuzzy_cutoff=0.72, token_jaccard_cutoff=0.5,
+                                batch_col_total=total_batch_col, batch_col_present=present_batch_col,
+                                total_norm=total_norm)
 
-        # save absentees CSV using original columns
+        # save absentees CSV using original columns, written straight from Arrow buffers
         subj_part = sanitize_filename_part(subject)
         date_part = sanitize_filename_part(date_for_file or date_display or datetime.now().date().isoformat())
         out_basename = f"absentees_{subj_part}_{date_part}.csv"
         out_path = os.path.join(OUTPUT_DIR, secure_filename(out_basename))
-        result["absentees_df"].to_csv(out_path, index=False, encoding="utf-8")
+        pcsv.write_csv(pa.Table.from_pandas(result["absentees_df"], preserve_index=False), out_path)
 
         # render result page
         return render_template("result.html",